@@ -30,6 +30,10 @@ else:
 ## Parse the config file
 cfg = read_yaml.read_yaml(config_file)
 
+# Keep the raw text of the config file so it can be written to the log at the end of the run (without re-reading and re-parsing it)
+with open(config_file) as file:
+    config_text = file.read()
+
 ### Run the Metashape workflow
 
 doc, log, run_id = meta.project_setup(cfg, config_file)
@@ -76,4 +80,8 @@ meta.build_dem_orthomosaic(doc, log, run_id, cfg)
 
 meta.export_report(doc, run_id, cfg)
 
-meta.finish_run(log, config_file)
+# The point cloud is only removed once all the steps that may use it are complete
+if cfg["buildPointCloud"]["remove_after_export"]:
+    meta.remove_point_clouds(doc)
+
+meta.finish_run(log, config_text)
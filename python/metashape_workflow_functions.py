@@ -7,15 +7,23 @@
 # import the fuctionality we need to make time stamps to measure performance
 import time
 import datetime
+import collections
+import functools
+import concurrent.futures
+import csv
 import platform
 import os
-import glob
 import re
-import yaml
 
 ### import the Metashape functionality
 import Metashape
 
+# numpy is optional: if available, it is used to speed up selecting tie point filter thresholds
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 #### Helper functions and globals
 
@@ -24,6 +32,59 @@ import Metashape
 # TODO: Consider moving log to json/yaml formatting using a dict
 sep = "; "
 
+# Used by enable_and_log_gpu to extract the GPU model names from the string representation of the GPU device list
+gpu_name_regex = re.compile(r"'name': '([^']*)'")
+
+
+# Open log file handles, keyed by log file path. Each log is opened once and kept open until finish_run, rather than being re-opened for every line.
+# Handles are line-buffered, so each line still reaches the file as soon as it is written (e.g. if a run crashes)
+log_handles = {}
+
+
+def get_log_handle(log_file):
+    """
+    Get the (cached) append handle for a log file, opening it on first use
+    """
+    file = log_handles.get(log_file)
+    if file is None:
+        file = open(log_file, "a", buffering=1)
+        log_handles[log_file] = file
+    return file
+
+
+def write_log(log_file, *lines):
+    """
+    Append one or more lines to the log file, in a single write. Each line is a list of fields, which are joined with sep
+    """
+    get_log_handle(log_file).write("".join(sep.join(line) + "\n" for line in lines))
+
+
+def close_log(log_file):
+    """
+    Close the handle of a log file, if it is open
+    """
+    file = log_handles.pop(log_file, None)
+    if file is not None:
+        file.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_crs(crs):
+    """
+    Get the Metashape CoordinateSystem for a CRS string (e.g. "EPSG::26910"). Each CRS is only constructed (which requires parsing its definition) once per run and then reused
+    """
+    return Metashape.CoordinateSystem(crs)
+
+
+@functools.lru_cache(maxsize=None)
+def get_ortho_projection(crs):
+    """
+    Get a Metashape OrthoProjection in the given CRS, constructed once per run and reused by every DEM and orthomosaic build and export
+    """
+    projection = Metashape.OrthoProjection()
+    projection.crs = get_crs(crs)
+    return projection
+
 
 def stamp_time():
     """
@@ -41,7 +102,70 @@ def diff_time(t2, t1):
     return total
 
 
-# Used by add_gcps function
+def get_subdivide_task(cfg, operation):
+    """
+    Whether to use fine-level task subdivision for the named Metashape operation (e.g. "buildDem").
+    An entry for the operation in cfg["subdivide_task_overrides"] takes precedence; otherwise cfg["subdivide_task"] is used
+    """
+    # configs written before subdivide_task_overrides existed don't have the key
+    overrides = cfg.get("subdivide_task_overrides") or {}
+    if operation in overrides:
+        return overrides[operation]
+    return cfg["subdivide_task"]
+
+
+# Used by find_photos function: file extensions of photos
+photo_extensions = (".tif", ".jpg", ".TIF", ".JPG")
+
+
+# Used by add_photos function
+def find_photos(photo_path):
+    """
+    Recursively find the paths of all photos (by file extension) under a directory, skipping hidden
+    files and directories (as glob does) and USGS DEM files ("dem_usgs.tif").
+    Photos are found in the same order as with glob: the files of each directory, then its subdirectories depth-first in listing order
+    """
+    dirs = [photo_path]
+    while dirs:
+        subdirs = []
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(photo_extensions) and not entry.name.endswith("dem_usgs.tif"):
+                    yield entry.path
+        # push the subdirectories in reverse so they are popped (walked depth-first) in listing order, giving the same photo order as glob
+        dirs.extend(reversed(subdirs))
+
+
+# Used by the filter_points_usgs functions
+def get_percentile_threshold(values, percent):
+    """
+    Get the threshold value that the given percent of values are at or above, i.e. the value at index int(n * (1 - percent / 100)) of the sorted values.
+    Uses numpy.partition, which only partially sorts (O(n)), if numpy is available; otherwise sorts the values
+    """
+    k = int(len(values) * (1 - percent / 100))
+    if np is not None:
+        return float(np.partition(np.asarray(values, dtype=np.float64), k)[k])
+    return sorted(values)[k]
+
+
+# Used by add_gcps function, to look up many markers and cameras by label
+def build_label_index(items, lower=False):
+    """
+    Make a dict of Metashape items (e.g. markers or cameras) keyed by their label (lowercased if lower=True), so items can be looked up by label without scanning the whole list.
+    If several items share a label, the first one is kept (as a linear scan would find)
+    """
+    index = {}
+    for item in items:
+        label = item.label.lower() if lower else item.label
+        index.setdefault(label, item)
+    return index
+
+
+# Single lookups by label. These stop at the first match, so they are cheaper than building an index for one lookup
 def get_marker(chunk, label):
     for marker in chunk.markers:
         if marker.label == label:
@@ -49,7 +173,6 @@ def get_marker(chunk, label):
     return None
 
 
-# Used by add_gcps function
 def get_camera(chunk, label):
     for camera in chunk.cameras:
         if camera.label.lower() == label.lower():
@@ -70,10 +193,8 @@ def project_setup(cfg, config_file):
     """
 
     # Make project directories (necessary even if loading an existing project because this workflow saves a new project based on the old one, leaving the old one intact
-    if not os.path.exists(cfg["output_path"]):
-        os.makedirs(cfg["output_path"])
-    if not os.path.exists(cfg["project_path"]):
-        os.makedirs(cfg["project_path"])
+    os.makedirs(cfg["output_path"], exist_ok=True)
+    os.makedirs(cfg["project_path"], exist_ok=True)
 
     ### Set a filename template for project files and output files based on the 'run_name' key of the config YML
     ## BUT if the value for run_name is "from_config_filename", then use the config filename for the run name.
@@ -92,6 +213,19 @@ def project_setup(cfg, config_file):
     project_file = os.path.join(cfg["project_path"], ".".join([run_id, "psx"]))
     log_file = os.path.join(cfg["output_path"], ".".join([run_id + "_log", "txt"]))
 
+    """
+    Resolve the project CRS
+    """
+
+    # Construct (and cache) the project CRS and force its full definition to be resolved now, so that the one-time cost of coordinate system (PROJ) initialization is logged separately rather than inflating the timing of the first step that uses the CRS
+    crs_start_time = time.time()
+    project_crs = get_crs(cfg["project_crs"])
+    # The values are discarded: accessing these properties is what forces PROJ to resolve the full definition (and the geographic and geocentric systems derived from it)
+    _ = project_crs.wkt
+    _ = project_crs.geogcs
+    _ = project_crs.geoccs
+    crs_time = diff_time(time.time(), crs_start_time)
+
     """
     Create a doc and a chunk
     """
@@ -105,8 +239,8 @@ def project_setup(cfg, config_file):
     else:
         # Initialize a chunk, set its CRS as specified
         chunk = doc.addChunk()
-        chunk.crs = Metashape.CoordinateSystem(cfg["project_crs"])
-        chunk.marker_crs = Metashape.CoordinateSystem(cfg["addGCPs"]["gcp_crs"])
+        chunk.crs = project_crs
+        chunk.marker_crs = get_crs(cfg["addGCPs"]["gcp_crs"])
 
     # Save doc doc as new project (even if we opened an existing project, save as a separate one so the existing project remains accessible in its original state)
     doc.save(project_file)
@@ -116,22 +250,20 @@ def project_setup(cfg, config_file):
     """
 
     # log Metashape version, CPU specs, time, and project location to results file
-    # open the results file
     # TODO: records the Slurm values for actual cpus and ram allocated
     # https://slurm.schedmd.com/sbatch.html#lbAI
-    with open(log_file, "a") as file:
-
+    write_log(
+        log_file,
         # write a line with the Metashape version
-        file.write(sep.join(["Project", run_id]) + "\n")
-        file.write(
-            sep.join(["Agisoft Metashape Professional Version", Metashape.app.version]) + "\n"
-        )
+        ["Project", run_id],
+        ["Agisoft Metashape Professional Version", Metashape.app.version],
         # write a line with the date and time
-        file.write(sep.join(["Processing started", stamp_time()]) + "\n")
+        ["Processing started", stamp_time()],
         # write a line with CPU info - if possible, improve the way the CPU info is found / recorded
-        file.write(sep.join(["Node", platform.node()]) + "\n")
-        file.write(sep.join(["CPU", platform.processor()]) + "\n")
-        # write two lines with GPU info: count and model names - this takes multiple steps to make it look clean in the end
+        ["Node", platform.node()],
+        ["CPU", platform.processor()],
+        ["Project CRS warm-up", crs_time],
+    )
 
     return doc, log_file, run_id
 
@@ -142,30 +274,35 @@ def enable_and_log_gpu(log_file, cfg):
     """
 
     gpustringraw = str(Metashape.app.enumGPUDevices())
-    gpucount = gpustringraw.count("name': '")
-    gpustring = ""
-    currentgpu = 1
-    while gpucount >= currentgpu:
-        if gpustring != "":
-            gpustring = gpustring + ", "
-        gpustring = gpustring + gpustringraw.split("name': '")[currentgpu].split("',")[0]
-        currentgpu = currentgpu + 1
-    # gpustring = gpustringraw.split("name': '")[1].split("',")[0]
+    gpu_names = gpu_name_regex.findall(gpustringraw)
+    gpucount = len(gpu_names)
+    gpustring = ", ".join(gpu_names)
     gpu_mask = Metashape.app.gpu_mask
 
-    with open(log_file, "a") as file:
-        file.write(sep.join(["Number of GPUs Found", str(gpucount)]) + "\n")
-        file.write(sep.join(["GPU Model", gpustring]) + "\n")
-        file.write(sep.join(["GPU Mask", str(gpu_mask)]) + "\n")
+    write_log(
+        log_file,
+        ["Number of GPUs Found", str(gpucount)],
+        ["GPU Model", gpustring],
+        ["GPU Mask", str(gpu_mask)],
+    )
 
-        # If a GPU exists but is not enabled, enable the 1st one
-        if (gpucount > 0) and (gpu_mask == 0):
-            Metashape.app.gpu_mask = 1
-            gpu_mask = Metashape.app.gpu_mask
-            file.write(sep.join(["GPU Mask Enabled", str(gpu_mask)]) + "\n")
+    # If GPUs exist but none is enabled, enable all of them so multi-GPU nodes are fully used. A mask that was already set (i.e. a user-selected subset of GPUs) is left as is
+    if (gpucount > 0) and (gpu_mask == 0):
+        Metashape.app.gpu_mask = (1 << gpucount) - 1
+        gpu_mask = Metashape.app.gpu_mask
+        write_log(log_file, ["GPU Mask Enabled", str(gpu_mask)])
+
+    # Log which of the GPUs will be used
+    write_log(
+        log_file,
+        *[
+            ["GPU " + str(i) + " (" + name + ") Enabled", str(bool(gpu_mask & (1 << i)))]
+            for i, name in enumerate(gpu_names)
+        ]
+    )
 
-        # This writes down all the GPU devices available
-        # file.write('GPU(s): '+str(Metashape.app.enumGPUDevices())+'\n')
+    # This writes down all the GPU devices available
+    # write_log(log_file, ["GPU(s)", str(Metashape.app.enumGPUDevices())])
 
     # set Metashape to *not* use the CPU during GPU steps (appears to be standard wisdom)
     Metashape.app.cpu_enable = False
@@ -192,78 +329,63 @@ def add_photos(doc, cfg):
     if (isinstance(photo_paths, str)):
         photo_paths = [photo_paths]
     
-    for photo_path in photo_paths:
-        
-        grp = doc.chunk.addCameraGroup()
-
-        ## Get paths to all the project photos
-        a = glob.iglob(
-            os.path.join(photo_path, "**", "*.*"), recursive=True
-        )  # (([jJ][pP][gG])|([tT][iI][fF]))
-        b = [path for path in a]
-        photo_files = [
-            x
-            for x in b
-            if (re.search("(.tif$)|(.jpg$)|(.TIF$)|(.JPG$)", x) and (not re.search("dem_usgs.tif", x)))
-        ]
+    # Cameras already in the project (e.g. if an existing project was loaded) were configured when they were added, so the steps below only process the cameras added here
+    n_existing_cameras = len(doc.chunk.cameras)
 
-        ## Add them
-        if cfg["multispectral"]:
-            doc.chunk.addPhotos(photo_files, layout=Metashape.MultiplaneLayout, group = grp)
-        else:
-            doc.chunk.addPhotos(photo_files, group = grp)
-            
-    ## Need to change the label on each camera so that it includes the containing folder(s)
-    for camera in doc.chunk.cameras:
-        path = camera.photo.path
-        camera.label = path
+    ## Get paths to all the project photos. Directories are searched in parallel because this is I/O-bound (especially on network
+    ## storage), but the photos are added from this thread only, one directory at a time in the order listed, as the Metashape API is not thread-safe
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(8, len(photo_paths)))) as executor:
+        for photo_files in executor.map(lambda photo_path: list(find_photos(photo_path)), photo_paths):
+
+            grp = doc.chunk.addCameraGroup()
+            n_cameras_before = len(doc.chunk.cameras)
+
+            ## Add them
+            if cfg["multispectral"]:
+                doc.chunk.addPhotos(photo_files, layout=Metashape.MultiplaneLayout, group = grp)
+            else:
+                doc.chunk.addPhotos(photo_files, group = grp)
+
+            ## Need to change the label on each camera so that it includes the containing folder(s). Only the cameras just added need it
+            for camera in doc.chunk.cameras[n_cameras_before:]:
+                camera.label = camera.photo.path
     
     if cfg["separate_calibration_per_path"] :
+        # Collect the new cameras of each group (keyed by group key) in a single pass over the cameras
+        cams_by_group = collections.defaultdict(list)
+        for cam in doc.chunk.cameras[n_existing_cameras:]:
+            if cam.group is not None:
+                cams_by_group[cam.group.key].append(cam)
+
         # Assign a different (new) sensor (i.e. independent calibration) to each group of photos
         for grp in doc.chunk.camera_groups:
+            cams = cams_by_group[grp.key]
+            if not cams:
+                continue
 
-            # Get the template for the sensor from the first photo in the group
-            for cam in doc.chunk.cameras:
-                if cam.group == grp:
-                    sensor = cam.sensor
-                    break
-
-            doc.chunk.addSensor(doc.chunk.cameras[0].sensor)
+            # Use the sensor of the first photo in the group as the template for the new sensor
+            doc.chunk.addSensor(cams[0].sensor)
             sensor = doc.chunk.sensors[-1]
-            
-            for cam in doc.chunk.cameras:
-                if cam.group == grp:
-                    cam.sensor = sensor
-                    
-        # Remove the first (deafult) sensor, which should no longer be assigned to any photos
-        doc.chunk.remove(doc.chunk.sensors[0])
+
+            for cam in cams:
+                cam.sensor = sensor
+
+        # Remove the first (deafult) sensor, which should no longer be assigned to any photos (unless cameras that were already in the project still use it)
+        default_sensor = doc.chunk.sensors[0]
+        if not any(cam.sensor == default_sensor for cam in doc.chunk.cameras[:n_existing_cameras]):
+            doc.chunk.remove(default_sensor)
 
     ## If specified, change the accuracy of the cameras to match the RTK flag (RTK fix if flag = 50, otherwise no fix
     if cfg["use_rtk"]:
-        for cam in doc.chunk.cameras:
+        # the accuracy vectors are the same for every camera, so build them once
+        fix_accuracy = Metashape.Vector([cfg["fix_accuracy"]] * 3)
+        nofix_accuracy = Metashape.Vector([cfg["nofix_accuracy"]] * 3)
+
+        for cam in doc.chunk.cameras[n_existing_cameras:]:
             rtkflag = cam.photo.meta["DJI/RtkFlag"]
-            if rtkflag == "50":
-                cam.reference.location_accuracy = Metashape.Vector(
-                    [cfg["fix_accuracy"], cfg["fix_accuracy"], cfg["fix_accuracy"]]
-                )
-                cam.reference.accuracy = Metashape.Vector(
-                    [cfg["fix_accuracy"], cfg["fix_accuracy"], cfg["fix_accuracy"]]
-                )
-            else:
-                cam.reference.location_accuracy = Metashape.Vector(
-                    [
-                        cfg["nofix_accuracy"],
-                        cfg["nofix_accuracy"],
-                        cfg["nofix_accuracy"],
-                    ]
-                )
-                cam.reference.accuracy = Metashape.Vector(
-                    [
-                        cfg["nofix_accuracy"],
-                        cfg["nofix_accuracy"],
-                        cfg["nofix_accuracy"],
-                    ]
-                )
+            accuracy = fix_accuracy if rtkflag == "50" else nofix_accuracy
+            cam.reference.location_accuracy = accuracy
+            cam.reference.accuracy = accuracy
 
     doc.save()
 
@@ -271,19 +393,21 @@ def add_photos(doc, cfg):
 
 
 def calibrate_reflectance(doc, cfg):
+    reflectance_cfg = cfg["calibrateReflectance"]
+
     # TODO: Handle failure to find panels, or mulitple panel images by returning error to user.
     doc.chunk.locateReflectancePanels()
     doc.chunk.loadReflectancePanelCalibration(
         os.path.join(
             cfg["photo_path"],
             "calibration",
-            cfg["calibrateReflectance"]["panel_filename"],
+            reflectance_cfg["panel_filename"],
         )
     )
     # doc.chunk.calibrateReflectance(use_reflectance_panels=True,use_sun_sensor=True)
     doc.chunk.calibrateReflectance(
-        use_reflectance_panels=cfg["calibrateReflectance"]["use_reflectance_panels"],
-        use_sun_sensor=cfg["calibrateReflectance"]["use_sun_sensor"],
+        use_reflectance_panels=reflectance_cfg["use_reflectance_panels"],
+        use_sun_sensor=reflectance_cfg["use_sun_sensor"],
     )
     doc.save()
 
@@ -296,24 +420,27 @@ def add_gcps(doc, cfg):
     See the helper script (and the comments therein) for details on how to prepare the data needed by this function: R/prep_gcps.R
     """
 
+    gcp_cfg = cfg["addGCPs"]
+
+    # Index markers and cameras by label once, rather than scanning them for every line of the GCP tables
+    markers_by_label = build_label_index(doc.chunk.markers)
+    cameras_by_label = build_label_index(doc.chunk.cameras, lower=True)
+
     ## Tag specific pixels in specific images where GCPs are located
     path = os.path.join(cfg["photo_path"], "gcps", "prepared", "gcp_imagecoords_table.csv")
-    file = open(path)
-    content = file.read().splitlines()
 
-    for line in content:
-        marker_label, camera_label, x_proj, y_proj = line.split(",")
-        if marker_label[0] == '"':  # if it's in quotes (from saving CSV in Excel), remove quotes
-            marker_label = marker_label[1:-1]  # need to get it out of the two pairs of quotes
-        if camera_label[0] == '"':  # if it's in quotes (from saving CSV in Excel), remove quotes
-            camera_label = camera_label[1:-1]
+    # the csv reader takes care of any quotes around values (e.g. from saving the CSV in Excel)
+    with open(path, newline="") as file:
+        rows = [row for row in csv.reader(file) if row]
 
-        marker = get_marker(doc.chunk, marker_label)
+    for marker_label, camera_label, x_proj, y_proj in rows:
+        marker = markers_by_label.get(marker_label)
         if not marker:
             marker = doc.chunk.addMarker()
             marker.label = marker_label
+            markers_by_label[marker_label] = marker
 
-        camera = get_camera(doc.chunk, camera_label)
+        camera = cameras_by_label.get(camera_label.lower())
         if not camera:
             print(camera_label + " camera not found in project")
             continue
@@ -323,34 +450,25 @@ def add_gcps(doc, cfg):
         )
 
     ## Assign real-world coordinates to each GCP
-    path = os.path.join(cfg["photo_path"], "gcps", "prepared", "gcp_table.csv")
+    location_accuracy = (gcp_cfg["marker_location_accuracy"],) * 3
 
-    file = open(path)
-    content = file.read().splitlines()
+    path = os.path.join(cfg["photo_path"], "gcps", "prepared", "gcp_table.csv")
 
-    for line in content:
-        marker_label, world_x, world_y, world_z = line.split(",")
-        if marker_label[0] == '"':  # if it's in quotes (from saving CSV in Excel), remove quotes
-            marker_label = marker_label[1:-1]  # need to get it out of the two pairs of quotes
+    with open(path, newline="") as file:
+        rows = [row for row in csv.reader(file) if row]
 
-        marker = get_marker(doc.chunk, marker_label)
+    for marker_label, world_x, world_y, world_z in rows:
+        marker = markers_by_label.get(marker_label)
         if not marker:
             marker = doc.chunk.addMarker()
             marker.label = marker_label
+            markers_by_label[marker_label] = marker
 
         marker.reference.location = (float(world_x), float(world_y), float(world_z))
-        marker.reference.accuracy = (
-            cfg["addGCPs"]["marker_location_accuracy"],
-            cfg["addGCPs"]["marker_location_accuracy"],
-            cfg["addGCPs"]["marker_location_accuracy"],
-        )
+        marker.reference.accuracy = location_accuracy
 
-    doc.chunk.marker_location_accuracy = (
-        cfg["addGCPs"]["marker_location_accuracy"],
-        cfg["addGCPs"]["marker_location_accuracy"],
-        cfg["addGCPs"]["marker_location_accuracy"],
-    )
-    doc.chunk.marker_projection_accuracy = cfg["addGCPs"]["marker_projection_accuracy"]
+    doc.chunk.marker_location_accuracy = location_accuracy
+    doc.chunk.marker_projection_accuracy = gcp_cfg["marker_projection_accuracy"]
 
     doc.save()
 
@@ -368,6 +486,8 @@ def align_photos(doc, log_file, run_id, cfg):
     Match photos, align cameras, optimize cameras
     """
 
+    align_cfg = cfg["alignPhotos"]
+
     #### Align photos
 
     # get a beginning time stamp
@@ -375,17 +495,17 @@ def align_photos(doc, log_file, run_id, cfg):
 
     # Align cameras
     doc.chunk.matchPhotos(
-        downscale=cfg["alignPhotos"]["downscale"],
-        subdivide_task=cfg["subdivide_task"],
-        keep_keypoints=cfg["alignPhotos"]["keep_keypoints"],
-        generic_preselection=cfg["alignPhotos"]["generic_preselection"],
-        reference_preselection=cfg["alignPhotos"]["reference_preselection"],
-        reference_preselection_mode=cfg["alignPhotos"]["reference_preselection_mode"],
+        downscale=align_cfg["downscale"],
+        subdivide_task=get_subdivide_task(cfg, "matchPhotos"),
+        keep_keypoints=align_cfg["keep_keypoints"],
+        generic_preselection=align_cfg["generic_preselection"],
+        reference_preselection=align_cfg["reference_preselection"],
+        reference_preselection_mode=align_cfg["reference_preselection_mode"],
     )
     doc.chunk.alignCameras(
-        adaptive_fitting=cfg["alignPhotos"]["adaptive_fitting"],
-        subdivide_task=cfg["subdivide_task"],
-        reset_alignment=cfg["alignPhotos"]["reset_alignment"],
+        adaptive_fitting=align_cfg["adaptive_fitting"],
+        subdivide_task=get_subdivide_task(cfg, "alignCameras"),
+        reset_alignment=align_cfg["reset_alignment"],
     )
     doc.save()
 
@@ -396,12 +516,11 @@ def align_photos(doc, log_file, run_id, cfg):
     time1 = diff_time(timer1b, timer1a)
 
     # optionally export
-    if cfg["alignPhotos"]["export"]:
+    if align_cfg["export"]:
         export_cameras(doc, run_id, cfg)
 
     # record results to file
-    with open(log_file, "a") as file:
-        file.write(sep.join(["Align Photos", time1]) + "\n")
+    write_log(log_file, ["Align Photos", time1])
 
     return True
 
@@ -424,6 +543,8 @@ def optimize_cameras(doc, log_file, run_id, cfg):
     Optimize cameras
     """
 
+    optimize_cfg = cfg["optimizeCameras"]
+
     # get a beginning time stamp
     timer1a = time.time()
 
@@ -434,7 +555,7 @@ def optimize_cameras(doc, log_file, run_id, cfg):
             doc.chunk.cameras[i].reference.enabled = False
 
     # Currently only optimizes the default parameters, which is not all possible parameters
-    doc.chunk.optimizeCameras(adaptive_fitting=cfg["optimizeCameras"]["adaptive_fitting"])
+    doc.chunk.optimizeCameras(adaptive_fitting=optimize_cfg["adaptive_fitting"])
 
     # get an ending time stamp
     timer1b = time.time()
@@ -443,64 +564,62 @@ def optimize_cameras(doc, log_file, run_id, cfg):
     time1 = diff_time(timer1b, timer1a)
 
     # record results to file
-    with open(log_file, "a") as file:
-        file.write(sep.join(["Optimize cameras", time1]) + "\n")
+    write_log(log_file, ["Optimize cameras", time1])
 
     doc.save()
 
     # optionally export, note this would override the export from align_cameras
-    if cfg["optimizeCameras"]["export"]:
+    if optimize_cfg["export"]:
         export_cameras(doc, run_id, cfg)
 
     return True
 
 
-def filter_points_usgs_part1(doc, log_file, cfg):
-
-    # get a beginning time stamp
-    timer1a = time.time()
+def filter_tie_points(doc, criterion, thresh_percent, thresh_absolute):
+    """
+    Remove the tie points with the worst values of a filter criterion (e.g. Metashape.TiePoints.Filter.ReprojectionError): the worst thresh_percent percent of points, but never points with values below thresh_absolute
+    """
+    fltr = Metashape.TiePoints.Filter()
+    fltr.init(doc.chunk, criterion)
+    thresh = get_percentile_threshold(fltr.values, thresh_percent)
+    if thresh < thresh_absolute:
+        thresh = thresh_absolute  # don't throw away too many points if they're all good
+    fltr.removePoints(thresh)
 
-    doc.chunk.optimizeCameras(adaptive_fitting=cfg["optimizeCameras"]["adaptive_fitting"])
 
-    rec_thresh_percent = cfg["filterPointsUSGS"]["rec_thresh_percent"]
-    rec_thresh_absolute = cfg["filterPointsUSGS"]["rec_thresh_absolute"]
-    proj_thresh_percent = cfg["filterPointsUSGS"]["proj_thresh_percent"]
-    proj_thresh_absolute = cfg["filterPointsUSGS"]["proj_thresh_absolute"]
-    reproj_thresh_percent = cfg["filterPointsUSGS"]["reproj_thresh_percent"]
-    reproj_thresh_absolute = cfg["filterPointsUSGS"]["reproj_thresh_absolute"]
+def filter_points_usgs_part1(doc, log_file, cfg):
 
-    fltr = Metashape.TiePoints.Filter()
-    fltr.init(doc.chunk, Metashape.TiePoints.Filter.ReconstructionUncertainty)
-    values = fltr.values.copy()
-    values.sort()
-    thresh = values[int(len(values) * (1 - rec_thresh_percent / 100))]
-    if thresh < rec_thresh_absolute:
-        thresh = rec_thresh_absolute  # don't throw away too many points if they're all good
-    fltr.removePoints(thresh)
+    filter_cfg = cfg["filterPointsUSGS"]
+    adaptive_fitting = cfg["optimizeCameras"]["adaptive_fitting"]
 
-    doc.chunk.optimizeCameras(adaptive_fitting=cfg["optimizeCameras"]["adaptive_fitting"])
+    # get a beginning time stamp
+    timer1a = time.time()
 
-    fltr = Metashape.TiePoints.Filter()
-    fltr.init(doc.chunk, Metashape.TiePoints.Filter.ProjectionAccuracy)
-    values = fltr.values.copy()
-    values.sort()
-    thresh = values[int(len(values) * (1 - proj_thresh_percent / 100))]
-    if thresh < proj_thresh_absolute:
-        thresh = proj_thresh_absolute  # don't throw away too many points if they're all good
-    fltr.removePoints(thresh)
+    doc.chunk.optimizeCameras(adaptive_fitting=adaptive_fitting)
 
-    doc.chunk.optimizeCameras(adaptive_fitting=cfg["optimizeCameras"]["adaptive_fitting"])
+    filter_tie_points(
+        doc,
+        Metashape.TiePoints.Filter.ReconstructionUncertainty,
+        filter_cfg["rec_thresh_percent"],
+        filter_cfg["rec_thresh_absolute"],
+    )
+    doc.chunk.optimizeCameras(adaptive_fitting=adaptive_fitting)
 
-    fltr = Metashape.TiePoints.Filter()
-    fltr.init(doc.chunk, Metashape.TiePoints.Filter.ReprojectionError)
-    values = fltr.values.copy()
-    values.sort()
-    thresh = values[int(len(values) * (1 - reproj_thresh_percent / 100))]
-    if thresh < reproj_thresh_absolute:
-        thresh = reproj_thresh_absolute  # don't throw away too many points if they're all good
-    fltr.removePoints(thresh)
+    filter_tie_points(
+        doc,
+        Metashape.TiePoints.Filter.ProjectionAccuracy,
+        filter_cfg["proj_thresh_percent"],
+        filter_cfg["proj_thresh_absolute"],
+    )
+    doc.chunk.optimizeCameras(adaptive_fitting=adaptive_fitting)
 
-    doc.chunk.optimizeCameras(adaptive_fitting=cfg["optimizeCameras"]["adaptive_fitting"])
+    filter_tie_points(
+        doc,
+        Metashape.TiePoints.Filter.ReprojectionError,
+        filter_cfg["reproj_thresh_percent"],
+        filter_cfg["reproj_thresh_absolute"],
+    )
+    doc.chunk.optimizeCameras(adaptive_fitting=adaptive_fitting)
 
     # get an ending time stamp
     timer1b = time.time()
@@ -509,32 +628,28 @@ def filter_points_usgs_part1(doc, log_file, cfg):
     time1 = diff_time(timer1b, timer1a)
 
     # record results to file
-    with open(log_file, "a") as file:
-        file.write(sep.join(["USGS filter points part 1", time1]) + "\n")
+    write_log(log_file, ["USGS filter points part 1", time1])
 
     doc.save()
 
 
 def filter_points_usgs_part2(doc, log_file, cfg):
 
+    filter_cfg = cfg["filterPointsUSGS"]
+    adaptive_fitting = cfg["optimizeCameras"]["adaptive_fitting"]
+
     # get a beginning time stamp
     timer1a = time.time()
 
-    doc.chunk.optimizeCameras(adaptive_fitting=cfg["optimizeCameras"]["adaptive_fitting"])
-
-    reproj_thresh_percent = cfg["filterPointsUSGS"]["reproj_thresh_percent"]
-    reproj_thresh_absolute = cfg["filterPointsUSGS"]["reproj_thresh_absolute"]
+    doc.chunk.optimizeCameras(adaptive_fitting=adaptive_fitting)
 
-    fltr = Metashape.TiePoints.Filter()
-    fltr.init(doc.chunk, Metashape.TiePoints.Filter.ReprojectionError)
-    values = fltr.values.copy()
-    values.sort()
-    thresh = values[int(len(values) * (1 - reproj_thresh_percent / 100))]
-    if thresh < reproj_thresh_absolute:
-        thresh = reproj_thresh_absolute  # don't throw away too many points if they're all good
-    fltr.removePoints(thresh)
-
-    doc.chunk.optimizeCameras(adaptive_fitting=cfg["optimizeCameras"]["adaptive_fitting"])
+    filter_tie_points(
+        doc,
+        Metashape.TiePoints.Filter.ReprojectionError,
+        filter_cfg["reproj_thresh_percent"],
+        filter_cfg["reproj_thresh_absolute"],
+    )
+    doc.chunk.optimizeCameras(adaptive_fitting=adaptive_fitting)
 
     # get an ending time stamp
     timer1b = time.time()
@@ -543,21 +658,21 @@ def filter_points_usgs_part2(doc, log_file, cfg):
     time1 = diff_time(timer1b, timer1a)
 
     # record results to file
-    with open(log_file, "a") as file:
-        file.write(sep.join(["USGS filter points part 2", time1]) + "\n")
+    write_log(log_file, ["USGS filter points part 2", time1])
 
     doc.save()
 
 
 def classify_ground_points(doc, log_file, run_id, cfg):
+    classify_cfg = cfg["classifyGroundPoints"]
 
     # get a beginning time stamp for the next step
     timer_a = time.time()
 
     doc.chunk.point_cloud.classifyGroundPoints(
-        max_angle=cfg["classifyGroundPoints"]["max_angle"],
-        max_distance=cfg["classifyGroundPoints"]["max_distance"],
-        cell_size=cfg["classifyGroundPoints"]["cell_size"],
+        max_angle=classify_cfg["max_angle"],
+        max_distance=classify_cfg["max_distance"],
+        cell_size=classify_cfg["cell_size"],
     )
 
     # get an ending time stamp for the previous step
@@ -569,11 +684,12 @@ def classify_ground_points(doc, log_file, run_id, cfg):
     doc.save()
 
     # record results to file
-    with open(log_file, "a") as file:
-        file.write(sep.join(["Classify Ground Points", time_tot]) + "\n")
+    write_log(log_file, ["Classify Ground Points", time_tot])
 
 
 def build_depth_maps(doc, log_file, cfg):
+    depth_cfg = cfg["buildDepthMaps"]
+
     ### Build depth maps
 
     # get a beginning time stamp for the next step
@@ -581,11 +697,11 @@ def build_depth_maps(doc, log_file, cfg):
 
     # build depth maps only instead of also building the point cloud ##?? what does
     doc.chunk.buildDepthMaps(
-        downscale=cfg["buildDepthMaps"]["downscale"],
-        filter_mode=cfg["buildDepthMaps"]["filter_mode"],
-        reuse_depth=cfg["buildDepthMaps"]["reuse_depth"],
-        max_neighbors=cfg["buildDepthMaps"]["max_neighbors"],
-        subdivide_task=cfg["subdivide_task"],
+        downscale=depth_cfg["downscale"],
+        filter_mode=depth_cfg["filter_mode"],
+        reuse_depth=depth_cfg["reuse_depth"],
+        max_neighbors=depth_cfg["max_neighbors"],
+        subdivide_task=get_subdivide_task(cfg, "buildDepthMaps"),
     )
 
     # get an ending time stamp for the previous step
@@ -595,8 +711,7 @@ def build_depth_maps(doc, log_file, cfg):
     time2 = diff_time(timer2b, timer2a)
 
     # record results to file
-    with open(log_file, "a") as file:
-        file.write(sep.join(["Build Depth Maps", time2]) + "\n")
+    write_log(log_file, ["Build Depth Maps", time2])
 
     doc.save()
 
@@ -606,6 +721,8 @@ def build_point_cloud(doc, log_file, run_id, cfg):
     Build point cloud
     """
 
+    ptcloud_cfg = cfg["buildPointCloud"]
+
     ### Build point cloud
 
     # get a beginning time stamp for the next step
@@ -613,9 +730,9 @@ def build_point_cloud(doc, log_file, run_id, cfg):
 
     # build point cloud
     doc.chunk.buildPointCloud(
-        max_neighbors=cfg["buildPointCloud"]["max_neighbors"],
-        keep_depth=cfg["buildPointCloud"]["keep_depth"],
-        subdivide_task=cfg["subdivide_task"],
+        max_neighbors=ptcloud_cfg["max_neighbors"],
+        keep_depth=ptcloud_cfg["keep_depth"],
+        subdivide_task=get_subdivide_task(cfg, "buildPointCloud"),
         point_colors=True,
     )
 
@@ -626,29 +743,28 @@ def build_point_cloud(doc, log_file, run_id, cfg):
     time3 = diff_time(timer3b, timer3a)
 
     # record results to file
-    with open(log_file, "a") as file:
-        file.write(sep.join(["Build Point Cloud", time3]) + "\n")
+    write_log(log_file, ["Build Point Cloud", time3])
 
     doc.save()
 
     # classify ground points if specified
-    if cfg["buildPointCloud"]["classify_ground_points"]:
+    if ptcloud_cfg["classify_ground_points"]:
         classify_ground_points(doc, log_file, run_id, cfg)
 
     ### Export points
 
-    if cfg["buildPointCloud"]["export"]:
+    if ptcloud_cfg["export"]:
 
         output_file = os.path.join(cfg["output_path"], run_id + "_points.laz")
 
-        if cfg["buildPointCloud"]["classes"] == "ALL":
+        if ptcloud_cfg["classes"] == "ALL":
             # call without classes argument (Metashape then defaults to all classes)
             doc.chunk.exportPointCloud(
                 path=output_file,
                 source_data=Metashape.PointCloudData,
                 format=Metashape.PointCloudFormatLAS,
-                crs=Metashape.CoordinateSystem(cfg["project_crs"]),
-                subdivide_task=cfg["subdivide_task"],
+                crs=get_crs(cfg["project_crs"]),
+                subdivide_task=get_subdivide_task(cfg, "exportPointCloud"),
             )
         else:
             # call with classes argument
@@ -656,11 +772,32 @@ def build_point_cloud(doc, log_file, run_id, cfg):
                 path=output_file,
                 source_data=Metashape.PointCloudData,
                 format=Metashape.PointCloudFormatLAZ,
-                crs=Metashape.CoordinateSystem(cfg["project_crs"]),
-                clases=cfg["buildPointCloud"]["classes"],
-                subdivide_task=cfg["subdivide_task"],
+                crs=get_crs(cfg["project_crs"]),
+                clases=ptcloud_cfg["classes"],
+                subdivide_task=get_subdivide_task(cfg, "exportPointCloud"),
             )
 
+        # optionally reorder the exported points along a space-filling curve so spatially close points are stored close together in the file
+        # (configs written before the reorder option existed don't have the key)
+        if ptcloud_cfg.get("reorder") == "morton":
+            # imported here so that numpy and laspy are only required when reordering is enabled
+            try:
+                from python import point_cloud_reorder
+            except ModuleNotFoundError as e:
+                # only fall back if the module itself can't be found by its package path (e.g. when running from within the python directory), not if one of its dependencies (numpy, laspy) is missing
+                if e.name not in ("python", "python.point_cloud_reorder"):
+                    raise
+                import point_cloud_reorder
+
+            start_time = time.time()
+
+            point_cloud_reorder.reorder_morton(output_file)
+
+            time_taken = diff_time(time.time(), start_time)
+
+            # record results to file
+            write_log(log_file, ["Reorder Point Cloud", time_taken])
+
     return True
 
 
@@ -669,35 +806,34 @@ def build_model(doc, log_file, run_id, cfg):
     Build and export the model
     """
 
+    model_cfg = cfg["buildModel"]
+
     start_time = time.time()
     # Build the mesh
     doc.chunk.buildModel(
         surface_type=Metashape.Arbitrary,
         interpolation=Metashape.EnabledInterpolation,
-        face_count=cfg["buildModel"]["face_count"],
-        face_count_custom=cfg["buildModel"][
-            "face_count_custom"
-        ],  # Only used if face_count is custom
+        face_count=model_cfg["face_count"],
+        face_count_custom=model_cfg["face_count_custom"],  # Only used if face_count is custom
         source_data=Metashape.DepthMapsData,
     )
 
     time_taken = diff_time(time.time(), start_time)
 
     # record results to file
-    with open(log_file, "a") as file:
-        file.write(sep.join(["Build Model", time_taken]) + "\n")
+    write_log(log_file, ["Build Model", time_taken])
 
     # Save the model
     doc.save()
 
-    if cfg["buildModel"]["export_georeferenced"]:
+    if model_cfg["export_georeferenced"]:
         output_file = os.path.join(
             cfg["output_path"],
-            run_id + "_model_georeferenced." + cfg["buildModel"]["export_extension"],
+            run_id + "_model_georeferenced." + model_cfg["export_extension"],
         )
         doc.chunk.exportModel(path=output_file)
 
-    if cfg["buildModel"]["export_local"]:
+    if model_cfg["export_local"]:
         # Wipe the CRS and transform so it aligns with the cameras
         # The approach was recommended here: https://www.agisoft.com/forum/index.php?topic=8210.0
         old_crs = doc.chunk.crs
@@ -707,7 +843,7 @@ def build_model(doc, log_file, run_id, cfg):
         doc.chunk.transform.matrix = None
 
         # Export the transform
-        if cfg["buildModel"]["export_transform"]:
+        if model_cfg["export_transform"]:
             output_file = os.path.join(
                 cfg["output_path"],
                 run_id + "_local_model_transform.csv",
@@ -723,7 +859,7 @@ def build_model(doc, log_file, run_id, cfg):
         # Export the model
         output_file = os.path.join(
             cfg["output_path"],
-            run_id + "_model_local." + cfg["buildModel"]["export_extension"],
+            run_id + "_model_local." + model_cfg["export_extension"],
         )
         doc.chunk.exportModel(path=output_file)
 
@@ -741,121 +877,90 @@ def build_dem_orthomosaic(doc, log_file, run_id, cfg):
     Build end export DEM
     """
 
+    dem_cfg = cfg["buildDem"]
+    ortho_cfg = cfg["buildOrthomosaic"]
+
     # classify ground points if specified
-    if cfg["buildDem"]["classify_ground_points"]:
+    if dem_cfg["classify_ground_points"]:
         classify_ground_points(doc, log_file, run_id, cfg)
 
-    if (cfg["buildDem"]["enabled"]):
+    if (dem_cfg["enabled"]):
         # prepping params for buildDem
-        projection = Metashape.OrthoProjection()
-        projection.crs = Metashape.CoordinateSystem(cfg["project_crs"])
+        projection = get_ortho_projection(cfg["project_crs"])
+        resolution = dem_cfg["resolution"]
 
-        # prepping params for export
+        # prepping params for export (shared by all DEM types)
         compression = Metashape.ImageCompression()
-        compression.tiff_big = cfg["buildDem"]["tiff_big"]
-        compression.tiff_tiled = cfg["buildDem"]["tiff_tiled"]
-        compression.tiff_overviews = cfg["buildDem"]["tiff_overviews"]
-
-        if ("DSM-ptcloud" in cfg["buildDem"]["surface"]):
-            start_time = time.time()
+        compression.tiff_big = dem_cfg["tiff_big"]
+        compression.tiff_tiled = dem_cfg["tiff_tiled"]
+        compression.tiff_overviews = dem_cfg["tiff_overviews"]
 
+        # The DEM types that can be built, in the order they are built: (surface name, data to build from, additional buildDem arguments)
+        dem_specs = [
             # call without point classes argument (Metashape then defaults to all classes)
-            doc.chunk.buildDem(
-                source_data=Metashape.PointCloudData,
-                subdivide_task=cfg["subdivide_task"],
-                projection=projection,
-                resolution=cfg["buildDem"]["resolution"]
-            )
+            ("DSM-ptcloud", Metashape.PointCloudData, {}),
+            # call with point classes argument to specify ground points only
+            ("DTM-ptcloud", Metashape.PointCloudData, {"classes": Metashape.PointClass.Ground}),
+            ("DSM-mesh", Metashape.ModelData, {}),
+        ]
 
-            time_taken = diff_time(time.time(), start_time)
+        for surface, source_data, dem_args in dem_specs:
 
-            # record results to file
-            with open(log_file, "a") as file:
-                file.write(sep.join(["Build DSM-ptcloud", time_taken]) + "\n")
-
-            output_file = os.path.join(cfg["output_path"], run_id + "_dsm-ptcloud.tif")
-            if cfg["buildDem"]["export"]:
-                doc.chunk.exportRaster(
-                    path=output_file,
-                    projection=projection,
-                    nodata_value=cfg["buildDem"]["nodata"],
-                    source_data=Metashape.ElevationData,
-                    image_compression=compression,
-                )
-                if cfg["buildOrthomosaic"]["enabled"] and "DSM-ptcloud" in cfg["buildOrthomosaic"]["surface"]:
-                    build_export_orthomosaic(doc, log_file, run_id, cfg, file_ending="dsm-ptcloud")
-        if ("DTM-ptcloud" in cfg["buildDem"]["surface"]):
+            if surface not in dem_cfg["surface"]:
+                continue
 
             start_time = time.time()
 
-            # call with point classes argument to specify ground points only
             doc.chunk.buildDem(
-                source_data=Metashape.PointCloudData,
-                classes=Metashape.PointClass.Ground,
-                subdivide_task=cfg["subdivide_task"],
+                source_data=source_data,
+                subdivide_task=get_subdivide_task(cfg, "buildDem"),
                 projection=projection,
-                resolution=cfg["buildDem"]["resolution"]
+                resolution=resolution,
+                **dem_args
             )
 
             time_taken = diff_time(time.time(), start_time)
 
             # record results to file
-            with open(log_file, "a") as file:
-                file.write(sep.join(["Build DTM-ptcloud", time_taken]) + "\n")
-
-            output_file = os.path.join(cfg["output_path"], run_id + "_dtm-ptcloud.tif")
-            if cfg["buildDem"]["export"]:
-                doc.chunk.exportRaster(
-                    path=output_file,
-                    projection=projection,
-                    nodata_value=cfg["buildDem"]["nodata"],
-                    source_data=Metashape.ElevationData,
-                    image_compression=compression,
-                )
-                if cfg["buildOrthomosaic"]["enabled"] and "DTM-ptcloud" in cfg["buildOrthomosaic"]["surface"]:
-                    build_export_orthomosaic(doc, log_file, run_id, cfg, file_ending="dtm-ptcloud")
-
-        if ("DSM-mesh" in cfg["buildDem"]["surface"]):
-
-            start_time = time.time()
+            write_log(log_file, ["Build " + surface, time_taken])
 
-            doc.chunk.buildDem(
-                source_data=Metashape.ModelData,
-                subdivide_task=cfg["subdivide_task"],
-                projection=projection,
-                resolution=cfg["buildDem"]["resolution"]
-            )
-
-            time_taken = diff_time(time.time(), start_time)
+            # file ending used in the names of the output files, e.g. "dsm-ptcloud"
+            file_ending = surface.lower()
 
-            # record results to file
-            with open(log_file, "a") as file:
-                file.write(sep.join(["Build DSM-mesh", time_taken]) + "\n")
-
-            output_file = os.path.join(cfg["output_path"], run_id + "_dsm-mesh.tif")
-            if cfg["buildDem"]["export"]:
-                doc.chunk.exportRaster(
-                    path=output_file,
-                    projection=projection,
-                    nodata_value=cfg["buildDem"]["nodata"],
-                    source_data=Metashape.ElevationData,
-                    image_compression=compression,
-                )
-                if cfg["buildOrthomosaic"]["enabled"] and "DSM-mesh" in cfg["buildOrthomosaic"]["surface"]:
-                    build_export_orthomosaic(doc, log_file, run_id, cfg, file_ending="dsm-mesh")
+            if dem_cfg["export"]:
+                export_dem(doc, run_id, cfg, file_ending, projection, compression)
+                if ortho_cfg["enabled"] and surface in ortho_cfg["surface"]:
+                    build_export_orthomosaic(doc, log_file, run_id, cfg, file_ending=file_ending)
 
     # Building an orthomosaic from the mesh does not require a DEM, so this is done separately, independent of any DEM building
-    if (cfg["buildOrthomosaic"]["enabled"] and "Mesh" in cfg["buildOrthomosaic"]["surface"]):
+    if (ortho_cfg["enabled"] and "Mesh" in ortho_cfg["surface"]):
         build_export_orthomosaic(doc, log_file, run_id, cfg, from_mesh = True, file_ending="mesh")
-    
-    if(cfg["buildPointCloud"]["remove_after_export"]):
-        doc.chunk.remove(doc.chunk.point_clouds)
 
+    # A single save for all DEMs and orthomosaics built above (build_export_orthomosaic does not save)
     doc.save()
 
     return True
 
 
+def export_dem(doc, run_id, cfg, file_ending, projection, compression):
+    """
+    Helper function called by build_dem_orthomosaic. Exports the current elevation data (DEM) to a GeoTIFF whose name ends with file_ending (e.g. "dsm-ptcloud")
+    """
+
+    output_file = os.path.join(cfg["output_path"], run_id + "_" + file_ending + ".tif")
+
+    doc.chunk.exportRaster(
+        path=output_file,
+        projection=projection,
+        nodata_value=cfg["buildDem"]["nodata"],
+        source_data=Metashape.ElevationData,
+        image_compression=compression,
+        subdivide_task=get_subdivide_task(cfg, "exportRaster"),
+    )
+
+    return output_file
+
+
 def build_export_orthomosaic(doc, log_file, run_id, cfg, file_ending, from_mesh = False):
     """
     Helper function called by build_dem_orthomosaic. build_export_orthomosaic builds and exports an ortho based on the current elevation data.
@@ -864,12 +969,13 @@ def build_export_orthomosaic(doc, log_file, run_id, cfg, file_ending, from_mesh
     Note that we have tried using the 'resolution' parameter of buildOrthomosaic, but it does not have any effect. An orthomosaic built onto a DSM always has a reslution of 1/4 the DSM, and one built onto the mesh has a resolution of ~the GSD.
     """
 
+    ortho_cfg = cfg["buildOrthomosaic"]
+
     # get a beginning time stamp for the next step
     timer6a = time.time()
 
-    # prepping params for buildDem
-    projection = Metashape.OrthoProjection()
-    projection.crs = Metashape.CoordinateSystem(cfg["project_crs"])
+    # prepping params for buildOrthomosaic and exportRaster (the same projection is used for both)
+    projection = get_ortho_projection(cfg["project_crs"])
 
     if from_mesh:
         surface_data = Metashape.ModelData
@@ -878,10 +984,10 @@ def build_export_orthomosaic(doc, log_file, run_id, cfg, file_ending, from_mesh
 
     doc.chunk.buildOrthomosaic(
         surface_data=surface_data,
-        blending_mode=cfg["buildOrthomosaic"]["blending"],
-        fill_holes=cfg["buildOrthomosaic"]["fill_holes"],
-        refine_seamlines=cfg["buildOrthomosaic"]["refine_seamlines"],
-        subdivide_task=cfg["subdivide_task"],
+        blending_mode=ortho_cfg["blending"],
+        fill_holes=ortho_cfg["fill_holes"],
+        refine_seamlines=ortho_cfg["refine_seamlines"],
+        subdivide_task=get_subdivide_task(cfg, "buildOrthomosaic"),
         projection=projection,
     )
 
@@ -892,33 +998,37 @@ def build_export_orthomosaic(doc, log_file, run_id, cfg, file_ending, from_mesh
     time6 = diff_time(timer6b, timer6a)
 
     # record results to file
-    with open(log_file, "a") as file:
-        file.write(sep.join(["Build Orthomosaic", time6]) + "\n")
-
-    doc.save()
+    write_log(log_file, ["Build Orthomosaic", time6])
 
     ## Export orthomosaic
-    if cfg["buildOrthomosaic"]["export"]:
+    if ortho_cfg["export"]:
         output_file = os.path.join(cfg["output_path"], run_id + "_ortho_" + file_ending + ".tif")
 
         compression = Metashape.ImageCompression()
-        compression.tiff_big = cfg["buildOrthomosaic"]["tiff_big"]
-        compression.tiff_tiled = cfg["buildOrthomosaic"]["tiff_tiled"]
-        compression.tiff_overviews = cfg["buildOrthomosaic"]["tiff_overviews"]
-
-        projection = Metashape.OrthoProjection()
-        projection.crs = Metashape.CoordinateSystem(cfg["project_crs"])
+        compression.tiff_big = ortho_cfg["tiff_big"]
+        compression.tiff_tiled = ortho_cfg["tiff_tiled"]
+        compression.tiff_overviews = ortho_cfg["tiff_overviews"]
+        # configs written before the tiff_compression option existed don't have the key: then Metashape's default compression is used
+        tiff_compression = ortho_cfg.get("tiff_compression")
+        if tiff_compression is not None:
+            compression.tiff_compression = tiff_compression
 
         doc.chunk.exportRaster(
             path=output_file,
             projection=projection,
-            nodata_value=cfg["buildOrthomosaic"]["nodata"],
+            nodata_value=ortho_cfg["nodata"],
             source_data=Metashape.OrthomosaicData,
             image_compression=compression,
+            subdivide_task=get_subdivide_task(cfg, "exportRaster"),
         )
     
-    if cfg["buildOrthomosaic"]["remove_after_export"]:
-        doc.chunk.remove(doc.chunk.orthomosaics)
+    if ortho_cfg["remove_after_export"]:
+        # remove a snapshot of the orthomosaic list (not the live property), and only if there is anything to remove
+        orthomosaics = list(doc.chunk.orthomosaics)
+        if orthomosaics:
+            doc.chunk.remove(orthomosaics)
+
+    # Not saved here: the caller (build_dem_orthomosaic) saves the project once after all DEMs and orthomosaics are built
 
     return True
 
@@ -935,23 +1045,40 @@ def export_report(doc, run_id, cfg):
     return True
 
 
-def finish_run(log_file, config_file):
+def remove_point_clouds(doc):
     """
-    Finish run (i.e., write completed time to log)
+    Remove the point cloud(s) from the project to reduce the project file size.
+    Called at the very end of the run, once every step that may use the point cloud (DEMs, orthomosaics, report) is complete, so the point cloud can never be needed (and have to be rebuilt) after it has been removed
     """
 
-    # finish local results log and close it for the last time
-    with open(log_file, "a") as file:
-        file.write(sep.join(["Run Completed", stamp_time()]) + "\n")
+    # remove a snapshot of the point cloud list (not the live property), and skip the removal and save if there is nothing to remove
+    point_clouds = list(doc.chunk.point_clouds)
+    if not point_clouds:
+        return True
 
-    # open run configuration again. We can't just use the existing cfg file because its objects had already been converted to Metashape objects (they don't write well)
-    with open(config_file) as file:
-        config_full = yaml.safe_load(file)
+    doc.chunk.remove(point_clouds)
+
+    doc.save()
+
+    return True
+
+
+def finish_run(log_file, config_text):
+    """
+    Finish run (i.e., write completed time to log)
+    """
+
+    # finish local results log, followed by the run configuration. We use the raw text of the config file as read at the start of the run (we can't just use the existing cfg because its objects had already been converted to Metashape objects, which don't write well)
+    # Everything is written in a single write on the open log handle
+    file = get_log_handle(log_file)
+    file.write(
+        sep.join(["Run Completed", stamp_time()])
+        + "\n\n\n### CONFIGURATION ###\n"
+        + config_text
+        + "\n### END CONFIGURATION ###\n"
+    )
 
-    # write the run configuration to the log file
-    with open(log_file, "a") as file:
-        file.write("\n\n### CONFIGURATION ###\n")
-        documents = yaml.dump(config_full, file, default_flow_style=False)
-        file.write("### END CONFIGURATION ###\n")
+    # flush and close the log for the last time
+    close_log(log_file)
 
     return True
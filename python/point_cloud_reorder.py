@@ -0,0 +1,77 @@
+# Helper for reordering the points of an exported point cloud file along a Morton (Z-order) curve,
+# so that points that are close in space are also close in the file. This makes subsequent spatial
+# reads of the file (e.g. rasterizing, tiling, building a COPC index) far more sequential.
+
+# Requires numpy and laspy (with a LAZ backend, e.g. lazrs, for .laz files). These are only needed
+# if point cloud reordering is enabled in the config.
+
+import os
+import tempfile
+
+import numpy as np
+import laspy
+
+# Number of bits each coordinate is quantized to; three of them interleave into a 63-bit key
+MORTON_BITS = 21
+
+
+def spread_bits(v):
+    """
+    Spread the lowest 21 bits of each value of an unsigned 64-bit array so there are two zero bits between each bit ("magic numbers" method)
+    """
+    v = v & np.uint64(0x1FFFFF)
+    v = (v | (v << np.uint64(32))) & np.uint64(0x1F00000000FFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x1F0000FF0000FF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x100F00F00F00F00F)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x10C30C30C30C30C3)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return v
+
+
+def quantize(coords):
+    """
+    Scale coordinates to integers spanning the full 21-bit range between their min and max
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    lo = coords.min()
+    span = coords.max() - lo
+    if span == 0:
+        return np.zeros(len(coords), dtype=np.uint64)
+    return ((coords - lo) * ((2**MORTON_BITS - 1) / span)).astype(np.uint64)
+
+
+def morton_keys(x, y, z):
+    """
+    Compute the 63-bit Morton key of each point from its x, y, and z coordinates
+    """
+    return (
+        spread_bits(quantize(x))
+        | (spread_bits(quantize(y)) << np.uint64(1))
+        | (spread_bits(quantize(z)) << np.uint64(2))
+    )
+
+
+def reorder_morton(path):
+    """
+    Rewrite the LAS/LAZ file at 'path' with its points sorted by Morton key. The whole point cloud is read into memory.
+    The reordered points are written to a temporary file next to 'path', which only replaces 'path' once the write has succeeded, so a failed write never destroys the original export
+    """
+    las = laspy.read(path)
+    if len(las.points) == 0:
+        return True
+
+    order = np.argsort(morton_keys(las.x, las.y, las.z), kind="stable")
+    las.points = las.points[order]
+
+    fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(path)[1], dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        # keep the compression of the original file (which, regardless of its extension, may be an uncompressed LAS), so no LAZ backend is needed to rewrite an uncompressed file
+        # Written through the open file rather than the path, because when given a path laspy decides on compression from the file extension and ignores do_compress
+        with os.fdopen(fd, "wb") as tmp_file:
+            las.write(tmp_file, do_compress=las.header.are_points_compressed)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return True
@@ -4,43 +4,124 @@ Created on Mon Oct 21 13:45:15 2019
 @author: Alex Mandel
 """
 
+import functools
+import operator
+import os
+import pickle
+import re
+import tempfile
 import yaml
 import Metashape
 
+# Use the LibYAML-based (C) loader if PyYAML was built with it, as it is much faster than the pure-Python one
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
-def convert_objects(a_dict):
+    print("PyYAML was built without LibYAML; using the slower pure-Python YAML parser. Install PyYAML with LibYAML support for faster config loading.")
+
+# Set this environment variable to "1" to cache parsed configs (pickled) next to the YAML file. Off by default: parsing a config takes milliseconds, and the cache file is unpickled (i.e. trusted) on later runs
+cache_env_var = "METASHAPE_CONFIG_CACHE"
+
+
+# Keys whose values are allowed to include "Metashape" without being converted (e.g. "photo_path" and "run_name" values may contain Metashape in a filename)
+exclude_key_regex = re.compile("path|project|name")
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_metashape(v):
+    """
+    Get the Metashape object a config string refers to (e.g. "Metashape.MosaicBlending" or "Metashape.PointClass.Ground") by walking its attribute path from the Metashape module, rather than evaluating it as Python code. Cached per distinct string
+    """
+    assert v.startswith("Metashape."), "Not a Metashape object: " + v
+    return operator.attrgetter(v[len("Metashape."):])(Metashape)
+
+
+def convert_objects(a_dict, _seen=None):
     """
     Convert strings that refer to metashape objects (e.g. "Metashape.MoasicBlending") into metashape objects
 
     Based on
     https://stackoverflow.com/a/25896596/237354
     """
+    # Skip dicts that were already converted (YAML anchors/aliases can make several keys share the same dict)
+    if _seen is None:
+        _seen = set()
+    if id(a_dict) in _seen:
+        return
+    _seen.add(id(a_dict))
+
     for k, v in a_dict.items():
         if not isinstance(v, dict):
             if isinstance(v, str):
-                # TODO look for Metashape.
-                if (
-                    v
-                    and "Metashape" in v
-                    and not ("path" in k)
-                    and not ("project" in k)
-                    and not ("name" in k)
-                ):  # allow "path" and "project" and "name" keys (e.g. "photoset_path" and "run_name") from YAML to include "Metashape" (e.g., Metashape in the filename)
-                    a_dict[k] = eval(v)
+                if v.startswith("Metashape.") and not exclude_key_regex.search(k):
+                    a_dict[k] = resolve_metashape(v)
             elif isinstance(v, list):
                 # skip if no item in list have metashape, else convert string to metashape object
-                if any("Metashape" in item for item in v):
-                    a_dict[k] = [eval(item) for item in v if ("Metashape" in item)]
+                metashape_items = [
+                    item for item in v if isinstance(item, str) and item.startswith("Metashape.")
+                ]
+                if metashape_items:
+                    a_dict[k] = [resolve_metashape(item) for item in metashape_items]
+        else:
+            convert_objects(v, _seen)
+
+
+def parse_yaml(yml_path):
+    """
+    Parse a YAML file into a dict. Returns the dict and whether the file contains any "Metashape."
+    strings (i.e. whether convert_objects has anything to convert).
+    If enabled (see cache_env_var), parsed configs are cached in "<yml_path>.cache.pkl", keyed by the file's modification time and
+    size, and reused as long as the YAML file is unchanged. Metashape objects are not converted (they
+    don't pickle), so the cache holds plain Python objects only.
+    """
+    use_cache = os.environ.get(cache_env_var, "0") == "1"
+    cache_path = yml_path + ".cache.pkl"
+    stat = os.stat(yml_path)
+    file_stamp = (stat.st_mtime_ns, stat.st_size)
+
+    if use_cache:
+        try:
+            with open(cache_path, "rb") as cachefile:
+                cached_stamp, cfg, has_metashape = pickle.load(cachefile)
+            if cached_stamp == file_stamp:
+                return cfg, has_metashape
+        except Exception:  # missing, unreadable, or stale-format cache: fall back to parsing
+            pass
+
+    # Read the whole file in one call and hand the bytes to the parser, rather than having the parser pull the file through many small reads
+    with open(yml_path, "rb") as ymlfile:
+        yml_bytes = ymlfile.read()
+    cfg = yaml.load(yml_bytes, Loader=SafeLoader)
+
+    # A single scan of the raw text tells whether there is anything for convert_objects to do
+    has_metashape = b"Metashape." in yml_bytes
+
+    if use_cache:
+        # Write to a temporary file and move it into place, so a concurrent or interrupted run never sees a partial cache
+        try:
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(cache_path)))
+        except OSError:  # e.g. the config directory is read-only: just don't cache
+            pass
         else:
-            convert_objects(v)
+            try:
+                with os.fdopen(fd, "wb") as cachefile:
+                    pickle.dump((file_stamp, cfg, has_metashape), cachefile, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                os.remove(tmp_path)
+
+    return cfg, has_metashape
 
 
 def read_yaml(yml_path):
-    with open(yml_path, "r") as ymlfile:
-        cfg = yaml.load(ymlfile, Loader=yaml.SafeLoader)
+    cfg, has_metashape = parse_yaml(yml_path)
 
     # TODO: wrap in a Try to catch errors
-    convert_objects(cfg)
+    # Skip walking the whole config if the file has no Metashape strings at all
+    if has_metashape:
+        convert_objects(cfg)
     
     return cfg
 
@@ -65,4 +146,4 @@ if __name__ == "__main__":
     GPU_num = cfg["GPU"]["GPU_num"]
 
     # Convert a to a Metashape Object
-    accuracy = eval(cfg["matchPhotos"]["accuracy"])
+    accuracy = resolve_metashape(cfg["matchPhotos"]["accuracy"])